@@ -1,41 +1,109 @@
+import io
 import os
 import re
 import random
 import shutil
 import string
+import hashlib
 import asyncio
+import logging
 import discord
 from pathlib import Path
+from functools import partial, lru_cache
 from contextlib import suppress
-from typing import Optional, List, Dict
+from collections import OrderedDict
+from typing import Optional, List, Dict, Tuple
 
 from redbot.core.utils.chat_formatting import pagify
 from redbot.core import commands, data_manager, Config
 
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+log = logging.getLogger("red.devilspal.pal")
 
 ALPHANUMERIC_CHARACTERS = string.ascii_letters + string.digits
+# trigger files up to this size are kept in memory after being sent once
+FILE_CACHE_MAX_FILE_SIZE = 8 * 1024 * 1024
+FILE_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# response files with this prefix live in the content-addressed store shared by all triggers
+CAS_PREFIX = "_cas/"
+# Discord's embed limits, the total size is lowered to leave room for the footer
+EMBED_MAX_FIELDS = 25
+EMBED_FIELD_MAX_SIZE = 1024
+EMBED_MAX_SIZE = 5500
+# patterns referring to groups by number or name, or setting global inline flags
+# (which would apply to the whole fused pattern), can't be fused with others
+UNFUSABLE_PATTERN = re.compile(r'\\\d|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+# names of the groups the fused pattern wraps each trigger's pattern in
+FUSED_GROUP_NAME = re.compile(r't\d+')
+
+
+def re2_options() -> "re2.Options":
+    options = re2.Options()
+    options.case_sensitive = False
+    options.log_errors = False
+    return options
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern: str) -> re.Pattern:
+    """
+    Compiles a case-insensitive pattern, preferring the linear-time RE2 engine if it's installed.
+    Patterns RE2 doesn't support (backreferences, lookarounds) are compiled with `re` instead.
+    Note that RE2's word boundaries and word and digit classes only cover ASCII, unlike `re`'s,
+    and that RE2's `$` doesn't match before a trailing newline, so 'foo$' won't match "foo\\n".
+    Raises `re.error` if `re` can't compile the pattern, even if RE2 could,
+    so that stored patterns keep working without RE2 installed.
+    Compiled patterns are cached and shared.
+    """
+    compiled = re.compile(pattern, re.I)
+    if re2 is not None:
+        with suppress(re2.error):
+            return re2.compile(pattern, re2_options())
+    return compiled
 
 
 class Trigger:
+    __slots__ = ("name", "pattern", "responses", "_responses_tuple", "_n")
 
     def __init__(self, name: str):
         self.name: str = name
         self.pattern: Optional[re.Pattern] = None
         self.responses: List[dict] = []
+        # read-only copy of the responses for the hot path, see 'refresh'
+        self._responses_tuple: Tuple[dict, ...] = ()
+        self._n: int = 0
+
+    def refresh(self):
+        """
+        Has to be called after every change to 'responses'.
+        """
+        self._responses_tuple = tuple(self.responses)
+        self._n = len(self._responses_tuple)
+
+    def pick_response(self) -> dict:
+        """
+        Returns a random response. The trigger must have at least one.
+        """
+        return self._responses_tuple[int(random.random() * self._n)]
 
     def check(self, author, content) -> Optional[dict]:
-        if not self.pattern or not self.responses:
+        if not self._n or not self.pattern:
+            return None
+        if self.pattern.search(content) is None:
             return None
-        match = self.pattern.search(content)
-        if match:
-            return random.choice(self.responses)
-        return None
+        return self.pick_response()
 
     @classmethod
     def from_dict(cls, d: dict):
         trigger = cls(d["name"])
-        trigger.pattern = re.compile(d["pattern"], re.I) if d["pattern"] else None
+        trigger.pattern = compile_pattern(d["pattern"]) if d["pattern"] else None
         trigger.responses = d["responses"]
+        trigger.refresh()
         return trigger
 
     def to_dict(self) -> dict:
@@ -60,29 +128,106 @@ class Pal(commands.Cog):
         self.bot = bot
         self.config = Config.get_conf(self, identifier=157205897611968514, force_registration=True)
         self.config.register_global(
-            triggers=[
-                {
+            # the old list of trigger dicts, only read to migrate it into 'trigger_map'
+            triggers=[],
+            trigger_map={
+                "default": {
                     "name": "default",
-                    "pattern": re.compile(r'^$'),
+                    "pattern": r'^$',
                     "responses": [],
                 }
-            ]
+            },
         )
-        self.mention_pattern: re.Pattern = None  # type: ignore
+        self._mention_prefixes: Tuple[str, ...] = ()
         self.triggers: Dict[str, Trigger] = {}
+        self._combined: Optional[re.Pattern] = None
+        self._active_triggers: List[Trigger] = []
+        self._group_to_trigger: Dict[str, Trigger] = {}
+        # file path -> file contents, least recently used first
+        self._file_cache: "OrderedDict[Path, bytes]" = OrderedDict()
+        self._file_cache_bytes: int = 0
         self._ready = asyncio.Event()
         self.bot.loop.create_task(self.initialize())
 
     async def initialize(self):
         trigger_list = await self.config.triggers()
-        self.triggers = {t["name"]: Trigger.from_dict(t) for t in trigger_list}
+        if trigger_list:
+            await self.config.trigger_map.set({t["name"]: t for t in trigger_list})
+            await self.config.triggers.clear()
+        trigger_map = await self.config.trigger_map()
+        self.triggers = {}
+        for n, d in trigger_map.items():
+            try:
+                trigger = Trigger.from_dict({"name": n, **d})
+            except re.error:
+                # a broken pattern shouldn't keep the whole cog from starting
+                log.exception("Invalid pattern for trigger %r, leaving it without one", n)
+                trigger = Trigger.from_dict({"name": n, **d, "pattern": None})
+            self.triggers[n] = trigger
+        self._refresh_active()
+        await self.migrate_files()
         await self.bot.wait_until_ready()  # wait until 'self.bot.user' is not None
-        self.mention_pattern = re.compile(f'<@!?{self.bot.user.id}> *')
+        # on_message relies on the order here - the nickname mention goes second
+        self._mention_prefixes = (f"<@{self.bot.user.id}>", f"<@!{self.bot.user.id}>")
         self._ready.set()
 
-    async def save(self):
-        trigger_list = [t.to_dict() for t in self.triggers.values()]
-        await self.config.triggers.set(trigger_list)
+    async def save_trigger(self, trigger: Trigger):
+        await self.config.trigger_map.set_raw(trigger.name, value=trigger.to_dict())
+        self._refresh_active()
+
+    def _refresh_active(self):
+        """
+        Collects the triggers that can fire - the ones with both a pattern and responses.
+        Has to be called after every change to the triggers or their responses.
+        """
+        self._active_triggers = [
+            t for t in self.triggers.values() if t.pattern is not None and t.responses
+        ]
+        self._rebuild_combined()
+
+    def _rebuild_combined(self):
+        """
+        Fuses the patterns of all active triggers into a single regex,
+        so that one match call decides which trigger fires.
+        Falls back to checking the triggers one by one if fusing isn't possible.
+        """
+        self._combined = None
+        self._group_to_trigger = {}
+        parts = []
+        user_groups = set()
+        for t in self._active_triggers:
+            if UNFUSABLE_PATTERN.search(t.pattern.pattern):
+                return
+            if re2 is not None and isinstance(t.pattern, re.Pattern):
+                # RE2 rejected this one, fusing would put every trigger on `re`
+                return
+            # named groups are kept as they are, so they have to be unique across
+            # the triggers and not clash with the fused pattern's own groups
+            for name in t.pattern.groupindex:
+                if name in user_groups or FUSED_GROUP_NAME.fullmatch(name):
+                    return
+                user_groups.add(name)
+            group = f"t{len(parts)}"
+            # the lazy prefix preserves trigger order - an earlier trigger wins
+            # regardless of where in the message the later one would match
+            parts.append(f"[\\s\\S]*?(?P<{group}>{t.pattern.pattern})")
+            self._group_to_trigger[group] = t
+        if not parts:
+            return
+        combined = '|'.join(parts)
+        if re2 is not None:
+            # never fall back to `re` here - that would lose RE2's linear-time guarantee
+            # for all triggers, leave them to the per-trigger loop instead
+            try:
+                self._combined = re2.compile(combined, re2_options())
+            except re2.error:
+                self._group_to_trigger = {}
+            return
+        try:
+            # not through 'compile_pattern' - stale fused patterns would crowd its cache
+            self._combined = re.compile(combined, re.I)
+        except re.error:
+            self._group_to_trigger = {}
 
     async def add_reactions(self, message: discord.Message, reactions: List[str]):
         for r in reactions:
@@ -96,34 +241,141 @@ class Pal(commands.Cog):
         path = path / "trigger_files" / trigger.name
         return path
 
+    async def run_in_thread(self, func, *args, **kwargs):
+        """
+        Runs blocking (disk I/O) calls in the default executor, to not block the event loop.
+        """
+        return await self.bot.loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+    def get_cas_folder(self) -> Path:
+        path = data_manager.cog_data_path(self)
+        path = path / "cas_files"
+        return path
+
+    def get_response_file_path(self, trigger: Trigger, filename: str) -> Path:
+        if filename.startswith(CAS_PREFIX):
+            return self.get_cas_folder() / filename[len(CAS_PREFIX):]
+        # files added before the content-addressed store existed
+        return self.get_trigger_folder(trigger) / filename
+
+    def store_file(self, path: Path) -> str:
+        """
+        Moves a file into the content-addressed store, or deletes it if the store already has it.
+        Returns the file name to put into the response.
+        """
+        h = hashlib.blake2b(path.read_bytes(), digest_size=16).hexdigest()
+        filename = f"{h}{path.suffix}"
+        cas_folder = self.get_cas_folder()
+        os.makedirs(cas_folder, exist_ok=True)
+        cas_path = cas_folder / filename
+        if cas_path.exists():
+            os.remove(path)
+        else:
+            os.replace(path, cas_path)
+        return f"{CAS_PREFIX}{filename}"
+
+    async def migrate_files(self):
+        """
+        Moves files of responses added before the content-addressed store existed into it.
+        Files that can't be moved are left where they are.
+        """
+        for t in self.triggers.values():
+            migrated = False
+            for r in t.responses:
+                if "file" not in r or r["file"].startswith(CAS_PREFIX):
+                    continue
+                path = self.get_trigger_folder(t) / r["file"]
+                try:
+                    stored = await self.run_in_thread(self.store_file, path)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    log.exception("Couldn't move %s into the file store", path)
+                    continue
+                # keep sending it under the name it had so far
+                r["name"] = r["file"]
+                r["file"] = stored
+                migrated = True
+            if migrated:
+                await self.save_trigger(t)
+
+    async def read_trigger_file(self, trigger: Trigger, filename: str) -> bytes:
+        path = self.get_response_file_path(trigger, filename)
+        data = self._file_cache.get(path)
+        if data is not None:
+            self._file_cache.move_to_end(path)
+            return data
+        data = await self.run_in_thread(path.read_bytes)
+        # another send could've cached the same file while this one was reading it
+        if path not in self._file_cache and len(data) <= FILE_CACHE_MAX_FILE_SIZE:
+            self._file_cache[path] = data
+            self._file_cache_bytes += len(data)
+            while self._file_cache_bytes > FILE_CACHE_MAX_SIZE:
+                _, old_data = self._file_cache.popitem(last=False)
+                self._file_cache_bytes -= len(old_data)
+        return data
+
+    async def discard_trigger_file(self, trigger: Trigger, filename: str):
+        """
+        Deletes the file of a removed response,
+        unless it's a stored file that some other response still uses.
+        """
+        if filename.startswith(CAS_PREFIX) and any(
+            r.get("file") == filename for t in self.triggers.values() for r in t.responses
+        ):
+            return
+        path = self.get_response_file_path(trigger, filename)
+        data = self._file_cache.pop(path, None)
+        if data is not None:
+            self._file_cache_bytes -= len(data)
+        with suppress(FileNotFoundError):
+            await self.run_in_thread(os.remove, path)
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         author = message.author
         if author.bot:
             return
-        await self._ready.wait()  # ensure initialization
+        if not self._ready.is_set():
+            await self._ready.wait()  # ensure initialization
         content = message.content
-        mention_match = self.mention_pattern.match(content)
-        if not mention_match:
+        prefixes = self._mention_prefixes
+        if not content.startswith(prefixes):
             return
+        # discard the mention at the start, along with any spaces after it
+        i = len(prefixes[1] if content[2] == '!' else prefixes[0])
+        while i < len(content) and content[i] == ' ':
+            i += 1
+        # this has to be a slice - with 'pos=i' passed to search/match instead,
+        # a '^' in a trigger pattern (like the default '^$') would never match
+        content = content[i:]
         # guild = message.guild
         channel = message.channel
-        content = content[len(mention_match.group(0)):]  # discard the mention at the start
 
-        for t in self.triggers.values():
-            response = t.check(author, content)
-            if response:
-                if "file" in response:
-                    path = self.get_trigger_folder(t)
-                    path /= response["file"]
-                    with path.open('rb') as file:
-                        await channel.send(
-                            f"{author.mention} {response['text']}",
-                            file=discord.File(file, path.name),
-                        )
-                else:
-                    await channel.send(f"{author.mention} {response['text']}")
-                break
+        if self._combined is not None:
+            match = self._combined.match(content)
+            if not match:
+                return
+            t = self._group_to_trigger[match.lastgroup]
+            response = t.pick_response()
+        else:
+            for t in self._active_triggers:
+                response = t.check(author, content)
+                if response:
+                    break
+            else:
+                return
+
+        if "file" in response:
+            data = await self.read_trigger_file(t, response["file"])
+            # the original file name, stored files are named after their hash
+            filename = response.get("name") or Path(response["file"]).name
+            await channel.send(
+                f"{author.mention} {response['text']}",
+                file=discord.File(io.BytesIO(data), filename),
+            )
+        else:
+            await channel.send(f"{author.mention} {response['text']}")
 
     # wait for cog initialization to complete
     async def cog_before_invoke(self, ctx):
@@ -144,8 +396,9 @@ class Pal(commands.Cog):
         if trigger:
             await ctx.send("This trigger already exists! :x:")
             return
-        self.triggers[trigger_name] = Trigger(trigger_name)
-        await self.save()
+        trigger = Trigger(trigger_name)
+        self.triggers[trigger_name] = trigger
+        await self.save_trigger(trigger)
         await ctx.send(f"Trigger `{trigger_name}` has been created!")
 
     @pal.command()
@@ -159,19 +412,18 @@ class Pal(commands.Cog):
         if ctx.message.attachments:
             # take only the first one
             a: discord.Attachment = ctx.message.attachments[0]
-            path = self.get_trigger_folder(trigger)
-            os.makedirs(path, exist_ok=True)
-            filename = "{}_{}".format(
-                ''.join(random.choice(ALPHANUMERIC_CHARACTERS) for i in range(8)),
-                a.filename,
-            )
+            # saved next to the stored files first, 'store_file' then moves it into place
+            path = self.get_cas_folder()
+            await self.run_in_thread(os.makedirs, path, exist_ok=True)
+            filename = f"{''.join(random.choices(ALPHANUMERIC_CHARACTERS, k=8))}_{a.filename}"
             path /= filename
             with path.open('wb') as file:
                 await a.save(file)
-            dict_response["file"] = filename
+            dict_response["file"] = await self.run_in_thread(self.store_file, path)
+            dict_response["name"] = a.filename
         trigger.responses.append(dict_response)
-        self.triggers[trigger.name] = trigger
-        await self.save()
+        trigger.refresh()
+        await self.save_trigger(trigger)
         await ctx.tick()
 
     @pal.command()
@@ -185,14 +437,16 @@ class Pal(commands.Cog):
                 "If you want to disable it, please remove all of the responses instead."
             )
             return
+        if trigger.pattern is not None and trigger.pattern.pattern == pattern:
+            await ctx.tick()  # nothing to change
+            return
         try:
-            compiled_pattern = re.compile(pattern, re.I)
+            compiled_pattern = compile_pattern(pattern)
         except re.error:
             await ctx.send("Invalid pattern! :x:")
             return
         trigger.pattern = compiled_pattern
-        self.triggers[trigger.name] = trigger
-        await self.save()
+        await self.save_trigger(trigger)
         await ctx.tick()
 
     @pal.command()
@@ -203,47 +457,51 @@ class Pal(commands.Cog):
         pages = []
         for r in trigger.responses:
             if "file" in r:
-                pages.append(f"{r['text']}\n\n**File:** {r['file']}")
+                pages.append(f"{r['text']}\n\n**File:** {r.get('name') or r['file']}")
             else:
                 pages.append(r["text"])
 
         page = 0
         emojis = ['◀', '❌', '🗑', '▶']
-        folder_path = self.get_trigger_folder(trigger)
+        emoji_set = frozenset(emojis)
         msg = await ctx.send("Loading...")
-        await self.add_reactions(msg, emojis)
+        # the pager works while the reactions are still being added
+        reactions_task = self.bot.loop.create_task(self.add_reactions(msg, emojis))
 
-        while True:
-            await msg.edit(content=pages[page])
-            try:
-                reaction, user = await self.bot.wait_for(
-                    "reaction_add", check=lambda r, u: r.emoji in emojis and u.id == ctx.author.id,
-                    timeout=30,
-                )
-            except asyncio.TimeoutError:
-                break
-            emoji = reaction.emoji
-            if emoji == '◀':
-                page -= 1
-            elif emoji == '▶':
-                page += 1
-            elif emoji == '❌':
-                break
-            elif emoji == '🗑':
-                del pages[page]
-                r = trigger.responses[page]
-                if "file" in r:
-                    path = folder_path / r["file"]
-                    try:
-                        os.remove(path)
-                    except FileNotFoundError:
-                        pass
-                del trigger.responses[page]
-                if not pages:
-                    await ctx.send("There's no more responses to delete!")
+        try:
+            while True:
+                await msg.edit(content=pages[page])
+                try:
+                    reaction, user = await self.bot.wait_for(
+                        "reaction_add",
+                        check=lambda r, u: r.emoji in emoji_set and u.id == ctx.author.id,
+                        timeout=30,
+                    )
+                except asyncio.TimeoutError:
+                    break
+                emoji = reaction.emoji
+                if emoji == '◀':
+                    page -= 1
+                elif emoji == '▶':
+                    page += 1
+                elif emoji == '❌':
                     break
-            page %= len(pages)
-            await reaction.remove(user)
+                elif emoji == '🗑':
+                    del pages[page]
+                    r = trigger.responses.pop(page)
+                    trigger.refresh()
+                    await self.save_trigger(trigger)
+                    if "file" in r:
+                        await self.discard_trigger_file(trigger, r["file"])
+                    if not pages:
+                        await ctx.send("There's no more responses to delete!")
+                        break
+                page %= len(pages)
+                await reaction.remove(user)
+        finally:
+            reactions_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await reactions_task
         await msg.clear_reactions()
 
     @pal.command()
@@ -259,9 +517,13 @@ class Pal(commands.Cog):
             return
         folder_path = self.get_trigger_folder(trigger)
         with suppress(FileNotFoundError):
-            shutil.rmtree(folder_path)
+            await self.run_in_thread(shutil.rmtree, folder_path)
         del self.triggers[trigger.name]
-        await self.save()
+        await self.config.trigger_map.clear_raw(trigger.name)
+        self._refresh_active()
+        for r in trigger.responses:
+            if "file" in r:
+                await self.discard_trigger_file(trigger, r["file"])
         await ctx.send(f"Trigger `{trigger.name}` has been deleted!")
 
     @pal.command()
@@ -269,7 +531,7 @@ class Pal(commands.Cog):
         """
         Lists all triggers.
         """
-        trigger_names = ', '.join(t.name for t in self.triggers.values())
+        trigger_names = ', '.join(self.triggers)
         pages = list(pagify(trigger_names, delims=[' '], shorten_by=10))
         if not pages:
             await ctx.send("There's no triggers to display!")
@@ -284,14 +546,23 @@ class Pal(commands.Cog):
         """
         pattern = trigger.pattern.pattern if trigger.pattern else None
         e = discord.Embed()
-        e.set_author(name=f"Trigger: {trigger.name}")
+        author = f"Trigger: {trigger.name}"
+        e.set_author(name=author)
         e.description = f"**Pattern:**\n\n`{pattern}`"
+        size = len(author) + len(e.description)
+        shown = 0
         for i, r in enumerate(trigger.responses, start=1):
+            name = f"Response #{i}"
+            file = f"\n\n**File:** {r.get('name') or r['file']}" if "file" in r else ""
+            limit = min(EMBED_FIELD_MAX_SIZE, EMBED_MAX_SIZE - size - len(name)) - len(file)
+            if i > EMBED_MAX_FIELDS or limit < 4:
+                break
             text = r["text"]
-            if len(text) > 1024:
-                text = text[:1020] + "..."
-            if "file" in r:
-                e.add_field(name=f"Response #{i}", value=f"{text}\n\n**File:** {r['file']}")
-            else:
-                e.add_field(name=f"Response #{i}", value=text)
+            if len(text) > limit:
+                text = text[:limit - 3] + "..."
+            e.add_field(name=name, value=text + file)
+            size += len(name) + len(text) + len(file)
+            shown = i
+        if shown < len(trigger.responses):
+            e.set_footer(text=f"{len(trigger.responses) - shown} more responses not shown")
         await ctx.send(embed=e)